@@ -1,12 +1,19 @@
 import sys
 import time
 import argparse
+import asyncio
 import csv
-from slack_sdk import WebClient
+import shelve
+import aiohttp
+from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_async_handlers import (
+    AsyncConnectionErrorRetryHandler,
+    AsyncRateLimitErrorRetryHandler,
+    AsyncServerErrorRetryHandler,
+)
 from dotenv import load_dotenv
 import os
-import requests
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,126 +21,282 @@ load_dotenv()
 # Initialize the Slack client
 client = None
 
-# Cache for user info and channel membership
-user_info_cache = {}
+# The app's own user ID from auth.test, used to ignore its "has joined the channel" messages
+bot_user_id = None
+
+# Cache for user emails (None for bots) and channel membership
+user_email_cache = {}
 channel_members_cache = {}
 
+# Persistent on-disk cache shared across runs, opened in main()
+persistent_cache = None
+CACHE_FILE = '.slack_cleaner_cache'
+cache_ttl = 86400
+# Workspace (team) ID prefixed to every key so runs against different workspaces don't share entries
+cache_namespace = None
+
+# Maximum number of channels processed concurrently
+MAX_CONCURRENT_CHANNELS = 16
+
+# Maximum number of users.profile.get fallback lookups in flight at once
+MAX_CONCURRENT_USER_LOOKUPS = 16
+user_lookup_semaphore = asyncio.Semaphore(MAX_CONCURRENT_USER_LOOKUPS)
+
+# In-flight fallback lookups shared across channels, and how many channels are waiting on each
+user_lookup_tasks = {}
+user_lookup_waiters = {}
+
+# Cap on the shared session's connection pool, sized to the channel and user lookup concurrency
+MAX_POOLED_CONNECTIONS = MAX_CONCURRENT_CHANNELS + MAX_CONCURRENT_USER_LOOKUPS
+
+# Serializes interactive prompts so concurrent channels don't interleave them
+prompt_lock = asyncio.Lock()
+
+# Function to read a value from the persistent cache if it has not expired
+def cache_get(key):
+    if persistent_cache is None:
+        return None
+    entry = persistent_cache.get(f"{cache_namespace}:{key}")
+    if entry and time.time() < entry['expires_at']:
+        return entry['value']
+    return None
+
+# Function to store a value in the persistent cache with the configured TTL
+def cache_set(key, value):
+    if persistent_cache is not None:
+        persistent_cache[f"{cache_namespace}:{key}"] = {'value': value, 'expires_at': time.time() + cache_ttl}
+
+# The SDK's server error handler only retries 500/503; also retry the 502/504 gateway
+# errors Slack's edge returns transiently, which the previous retry loop covered
+class ServerErrorRetryHandler(AsyncServerErrorRetryHandler):
+    async def _can_retry_async(self, *, state, request, response=None, error=None):
+        return response is not None and response.status_code in (500, 502, 503, 504)
+
 # Add this decorator at the top of the file, after the cache definitions
+# Rate limits, server errors and connection errors are retried by the client's retry handlers
 def handle_slack_error(func):
-    def wrapper(*args, **kwargs):
-        while True:
-            try:
-                return func(*args, **kwargs)
-            except SlackApiError as e:
-                if e.response.status_code == 429:
-                    retry_after = int(e.response.headers.get('Retry-After', 1))
-                    print(f"Rate limited. Retrying after {retry_after} seconds.")
-                    time.sleep(retry_after)
-                else:
-                    print(f"Slack API error: {e.response['error']}")
-                    return None
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except SlackApiError as e:
+            print(f"Slack API error: {e.response['error']}")
+            return None
     return wrapper
 
-# Function to get channels
+# Conversation types that can be checked; DMs (im, mpim) are excluded because Slack can't archive them
+CHANNEL_TYPES = ('public_channel', 'private_channel')
+
+# Function to parse --channel-types into a de-duplicated list of known types
+def parse_channel_types(value):
+    channel_types = list(dict.fromkeys(t.strip() for t in value.split(',') if t.strip()))
+    if not channel_types:
+        raise argparse.ArgumentTypeError("at least one channel type is required")
+    unknown = [t for t in channel_types if t not in CHANNEL_TYPES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown channel type(s) {', '.join(unknown)}; choose from {', '.join(CHANNEL_TYPES)}")
+    return channel_types
+
+# Function to get channels of a single conversation type
 @handle_slack_error
-def get_channels():
-    response = client.conversations_list(limit=999, exclude_archived=True)
-    return response['channels']
+async def get_channels_of_type(channel_type):
+    channels = []
+    cursor = None
+    while True:
+        response = await client.conversations_list(limit=200, cursor=cursor, exclude_archived=True, types=channel_type)
+        channels.extend(response['channels'])
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            break
+    return channels
+
+# Function to get channels
+async def get_channels(channel_types=('public_channel',)):
+    channels = []
+    # Slack filters types server-side; one paginated listing per type avoids a broad mixed scan
+    for channel_type in channel_types:
+        typed_channels = await get_channels_of_type(channel_type)
+        if typed_channels is None:
+            # e.g. missing_scope for private_channel; keep the types that could be listed
+            print(f"Skipping {channel_type} channels")
+            continue
+        channels.extend(typed_channels)
+    return channels
 
-# Function to get channel users with caching
+# Function to get channel users with caching; live runs skip the on-disk cache so archive decisions use current membership
 @handle_slack_error
-def get_channel_users(channel_id):
+async def get_channel_users(channel_id, use_persistent_cache=True):
     if channel_id in channel_members_cache:
         return channel_members_cache[channel_id]
-    response = client.conversations_members(channel=channel_id)
-    channel_members_cache[channel_id] = response['members']
-    return response['members']
-
-# Function to get user info with caching
-def get_user_info(user_id):
-    if user_id in user_info_cache:
-        return user_info_cache[user_id]
+    members = cache_get(f"members:{channel_id}") if use_persistent_cache else None
+    if members is not None:
+        channel_members_cache[channel_id] = members
+        return members
+    members = []
+    cursor = None
+    while True:
+        response = await client.conversations_members(channel=channel_id, limit=1000, cursor=cursor)
+        members.extend(response['members'])
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            break
+    channel_members_cache[channel_id] = members
+    cache_set(f"members:{channel_id}", members)
+    return members
+
+# Function to get the email to check for a user, or None for bots which are ignored
+def email_for_user(user):
+    if user.get('is_bot') or user.get('profile', {}).get('bot_id'):
+        return None
+    return user.get('profile', {}).get('email', '')
+
+# Function to prefetch all workspace user emails into the user email cache
+@handle_slack_error
+async def prefetch_users():
+    emails = cache_get('user_emails')
+    if emails is not None:
+        user_email_cache.update(emails)
+        return
+    emails = {}
+    cursor = None
+    while True:
+        response = await client.users_list(limit=1000, cursor=cursor)
+        for user in response['members']:
+            emails[user['id']] = email_for_user(user)
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            break
+    user_email_cache.update(emails)
+    cache_set('user_emails', emails)
+
+# Function to get a user's email with caching (fallback for users missing from the prefetch)
+async def get_user_email(user_id):
+    if user_id in user_email_cache:
+        return user_email_cache[user_id]
+    email = cache_get(f"email:{user_id}")
+    if email is not None:
+        user_email_cache[user_id] = email
+        return email
     try:
-        response = client.users_info(user=user_id)
-        user_info_cache[user_id] = response['user']
-        return response['user']
+        async with user_lookup_semaphore:
+            response = await client.users_profile_get(user=user_id)
+        email = email_for_user({'profile': response['profile']})
+        user_email_cache[user_id] = email
+        if email is not None:
+            cache_set(f"email:{user_id}", email)
+        return email
     except SlackApiError as e:
-        print(f"Error fetching user info: {e.response['error']}")
-        return None
+        # Count a failed lookup as a non-matching email so it can never cause an archive
+        print(f"Error fetching user profile: {e.response['error']}")
+        return ''
 
 # Function to join a channel
-def join_channel(channel_id, channel_name=None):
+async def join_channel(channel_id, channel_name=None):
     try:
-        client.conversations_join(channel=channel_id)
+        await client.conversations_join(channel=channel_id)
         print(f"Joined channel #{channel_name}")
     except SlackApiError as e:
         print(f"Error joining channel #{channel_name}: {e.response['error']}")
 
-# Function to check if a channel is archived
-def is_channel_archived(channel_id):
-    try:
-        response = client.conversations_info(channel=channel_id)
-        return response['channel']['is_archived']
-    except SlackApiError as e:
-        print(f"Error checking if channel is archived: {e.response['error']}")
-        return False
+# Function to check if a message is the app's own "has joined the channel" event
+def is_own_join_message(message):
+    return message.get('subtype') == 'channel_join' and message.get('user') == bot_user_id
+
+# Function to drop the app's own join messages, which would otherwise make every joined channel look active
+def without_own_join_messages(messages):
+    return [message for message in messages if not is_own_join_message(message)]
 
 # Function to fetch channel history with optional join
-def fetch_channel_history(channel_id, join_channels, channel_name):
+async def fetch_channel_history(channel, join_channels):
+    channel_id = channel['id']
+    channel_name = channel.get('name', channel['id'])
     try:
-        response = client.conversations_history(channel=channel_id)
-        return response['messages']
+        # Fetch two so the app's own join message can be skipped
+        response = await client.conversations_history(channel=channel_id, limit=2)
+        return without_own_join_messages(response['messages'])
     except SlackApiError as e:
         if e.response['error'] == 'not_in_channel':
             if join_channels:
-                if not is_channel_archived(channel_id):
-                    join_channel(channel_id, channel_name)
-                return retry_fetch_channel_history(channel_id, channel_name)
+                if not channel.get('is_archived'):
+                    await join_channel(channel_id, channel_name)
+                return await retry_fetch_channel_history(channel_id, channel_name)
             else:
-                return prompt_and_join_channel(channel_id, channel_name)
+                return await prompt_and_join_channel(channel)
         else:
             print(f"Error fetching channel history: {e.response['error']}")
             return []
 
 # Helper function to retry fetching channel history after joining
-def retry_fetch_channel_history(channel_id, channel_name):
+async def retry_fetch_channel_history(channel_id, channel_name):
     try:
-        response = client.conversations_history(channel=channel_id)
-        return response['messages']
+        # Fetch two so the app's own join message can be skipped
+        response = await client.conversations_history(channel=channel_id, limit=2)
+        return without_own_join_messages(response['messages'])
     except SlackApiError as e:
         print(f"Error fetching channel #{channel_name} history after joining: {e.response['error']}")
         return []
 
 # Helper function to prompt user and join channel if confirmed
-def prompt_and_join_channel(channel_id, channel_name):
-    user_input = input(f"The Slack Cleaner app does not have access to #{channel_name} channel, would you like to join? [Nya] ").strip().lower()
+async def prompt_and_join_channel(channel):
+    channel_id = channel['id']
+    channel_name = channel.get('name', channel['id'])
+    async with prompt_lock:
+        user_input = (await asyncio.to_thread(input, f"The Slack Cleaner app does not have access to #{channel_name} channel, would you like to join? [Nya] ")).strip().lower()
     if user_input in ['y', 'yes']:
-        if not is_channel_archived(channel_id):
-            join_channel(channel_id, channel_name)
-        return retry_fetch_channel_history(channel_id, channel_name)
+        if not channel.get('is_archived'):
+            await join_channel(channel_id, channel_name)
+        return await retry_fetch_channel_history(channel_id, channel_name)
     else:
         print(f"Skipping channel #{channel_id}")
         return []
 
 # Function to get channel history
-def get_channel_history(channel_id, join_channels, channel_name):
-    return fetch_channel_history(channel_id, join_channels, channel_name)
+async def get_channel_history(channel, join_channels):
+    return await fetch_channel_history(channel, join_channels)
+
+# Whether conversations.info includes latest for this token; cleared the first time it doesn't
+conversations_info_has_latest = True
+
+# Function to get the timestamp of the most recent message, preferring conversations.info over history
+async def get_last_message_time(channel, join_channels):
+    global conversations_info_has_latest
+    # Members can read history directly in one call; only try conversations.info for channels the app
+    # hasn't joined, and stop once it has shown it doesn't return latest for this token
+    if conversations_info_has_latest and not channel.get('is_member') and not isinstance(channel.get('latest'), dict):
+        try:
+            response = await client.conversations_info(channel=channel['id'], include_num_members=False)
+            # Merge the info response so the history/join fallback below sees the current is_archived
+            channel.update(response['channel'])
+            if 'latest' not in response['channel']:
+                conversations_info_has_latest = False
+        except SlackApiError as e:
+            print(f"Error fetching channel info: {e.response['error']}")
+    latest = channel.get('latest')
+    if isinstance(latest, dict) and latest.get('ts') and not is_own_join_message(latest):
+        return float(latest['ts'])
+
+    history = await get_channel_history(channel, join_channels)
+    if history:
+        return float(history[0]['ts'])
+    return None
 
 # Function to archive a channel
-def archive_channel(channel_id, dry_run=True, channel_name=None, reason=None, closing_message=None):
+async def archive_channel(channel_id, dry_run=True, channel_name=None, reason=None, closing_message=None):
     """
     Close a Slack channel by optionally posting a closing message and then archiving it.
+    Returns the CSV row for the channel, or None if archiving failed.
     """
+    row = [channel_id, channel_name, reason]
     if dry_run:
         print(f"Dry run: Would close channel {channel_name}")
         if closing_message:
             print(f"Dry run: Would post closing message: {closing_message}")
         print(f"Dry run: Would archive channel for reason: {reason}")
+        return row
     else:
         try:
             if closing_message:
                 try:
-                    client.chat_postMessage(
+                    await client.chat_postMessage(
                         channel=channel_id,
                         text=closing_message,
                         parse='full'
@@ -143,72 +306,153 @@ def archive_channel(channel_id, dry_run=True, channel_name=None, reason=None, cl
                     print(f"Error posting closing message: {e.response['error']}")
 
             # Archive the channel
-            client.conversations_archive(channel=channel_id)
+            await client.conversations_archive(channel=channel_id)
             print(f"Closed and archived channel {channel_name} for reason: {reason}")
+            return row
         except SlackApiError as e:
             print(f"Error closing channel: {e.response['error']}")
+            return None
+
+# Function to check whether a user counts as matching the email domains (bots are ignored)
+def user_matches_domains(email, email_domains):
+    if email is None:
+        return True
+    return email.lower().endswith(email_domains)
+
+# Function to check that every channel member matches, looking up uncached users concurrently
+async def all_users_match_domains(users, email_domains):
+    users = [user_id for user_id in users if user_id != 'USLACKBOT']
+    uncached = [user_id for user_id in users if user_id not in user_email_cache]
+    for user_id in users:
+        if user_id in user_email_cache and not user_matches_domains(user_email_cache[user_id], email_domains):
+            return False
+    if not uncached:
+        return True
+
+    tasks = []
+    for user_id in uncached:
+        if user_id not in user_lookup_tasks:
+            user_lookup_tasks[user_id] = asyncio.create_task(get_user_email(user_id))
+        user_lookup_waiters[user_id] = user_lookup_waiters.get(user_id, 0) + 1
+        tasks.append(user_lookup_tasks[user_id])
+    try:
+        for future in asyncio.as_completed(tasks):
+            if not user_matches_domains(await future, email_domains):
+                return False
+        return True
+    finally:
+        # Cancel lookups no other channel is waiting on, and collect their outcomes
+        abandoned = []
+        for user_id, task in zip(uncached, tasks):
+            user_lookup_waiters[user_id] -= 1
+            if user_lookup_waiters[user_id] == 0:
+                del user_lookup_waiters[user_id]
+                if user_lookup_tasks.get(user_id) is task:
+                    del user_lookup_tasks[user_id]
+                task.cancel()
+                abandoned.append(task)
+        await asyncio.gather(*abandoned, return_exceptions=True)
 
 # Add new function to handle channel archiving logic
-def should_archive_channel(channel, history, email_domains, days, args):
+async def should_archive_channel(channel, email_domains, cutoff, join_channels, dry_run, args):
     channel_id = channel['id']
-    channel_name = channel['name']
-    
-    # Check for inactivity
-    if days is not None and history:
-        last_message_time = float(history[1]['ts'])
-        if args.verbose:
-            print(f"Second-to-last message in channel {channel_name} was {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_message_time))}")
-        if time.time() - last_message_time > days * 24 * 60 * 60:
-            return True, f"Most recent message is {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_message_time))}"
-    
-    # Check email domains
-    users = get_channel_users(channel_id)
-    if users and not channel['is_archived']:
+    channel_name = channel.get('name', channel['id'])
+
+    # Check email domains first; member lookups are served from the prefetched user cache
+    users = await get_channel_users(channel_id, use_persistent_cache=dry_run)
+    if users and not channel.get('is_archived'):
         if args.verbose:
             print(f"Checking channel #{channel_name} with {len(users)} users")
-        all_users_match = True
-        for user_id in users:
-            user_info = get_user_info(user_id)
-            if user_info:
-                email = user_info['profile'].get('email', '')
-                if not any(email.endswith(domain) for domain in email_domains):
-                    all_users_match = False
-                    break
+        all_users_match = await all_users_match_domains(users, email_domains)
         if args.verbose:
             print(f"Channel #{channel_name} has users from {' '.join(email_domains)}: {all_users_match}")
         if all_users_match:
             return True, "No users in specified domains"
-    
+
+    # Check for inactivity, only fetching history when it is needed
+    if cutoff is not None:
+        last_message_time = await get_last_message_time(channel, join_channels)
+        if last_message_time is not None:
+            if args.verbose:
+                print(f"Most recent message in channel {channel_name} was {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_message_time))}")
+            if last_message_time < cutoff:
+                return True, f"Most recent message is {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_message_time))}"
+
     return False, None
 
-# Main function to clean up Slack instance
-def clean_up_slack(email_domains, dry_run=True, days=None, join_channels=False, csv_filename=None, closing_message=None):
-    csv_writer = None
-    if csv_filename:
-        csv_file = open(csv_filename, 'w', newline='')
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(['Channel ID', 'Channel Name', 'Reason'])
+# Process a single channel, bounded by the shared semaphore; returns the CSV row when archived
+async def process_channel(channel, semaphore, email_domains, dry_run, cutoff, join_channels, closing_message):
+    channel_id = channel['id']
+    channel_name = channel.get('name', channel['id'])
 
-    channels = get_channels()
-    for channel in channels:
-        channel_id = channel['id']
-        channel_name = channel['name']
-        
+    async with semaphore:
         try:
-            history = get_channel_history(channel_id, join_channels, channel_name)
-            should_archive, reason = should_archive_channel(channel, history, email_domains, days, args)
-            
+            should_archive, reason = await should_archive_channel(channel, email_domains, cutoff, join_channels, dry_run, args)
+
             if should_archive:
-                if not dry_run:
-                    archive_channel(channel_id, dry_run, channel_name, reason, closing_message)
-                if csv_writer:
-                    csv_writer.writerow([channel_id, channel_name, reason])
+                return await archive_channel(channel_id, dry_run, channel_name, reason, closing_message)
 
         except Exception as e:
             print(f"Error processing channel #{channel_name}: {e}")
+    return None
+
+# Function to run the channel checks concurrently, passing each archived row to on_row as soon as it completes
+async def process_channels(email_domains, dry_run, cutoff, join_channels, closing_message, channel_types, on_row=None):
+    await prefetch_users()
+    channels = await get_channels(channel_types)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHANNELS)
+    tasks = [
+        process_channel(channel, semaphore, email_domains, dry_run, cutoff, join_channels, closing_message)
+        for channel in channels
+    ]
+    for future in asyncio.as_completed(tasks):
+        row = await future
+        if row and on_row:
+            on_row(row)
+
+# Main function to clean up Slack instance
+async def clean_up_slack(email_domains, dry_run=True, days=None, join_channels=False, csv_filename=None, closing_message=None, channel_types=('public_channel',)):
+    email_domains = tuple(domain.lower() for domain in email_domains)
+    # Messages older than this timestamp count as inactive; computed once for the whole run
+    cutoff = time.time() - days * 24 * 60 * 60 if days is not None else None
+    if not csv_filename:
+        await process_channels(email_domains, dry_run, cutoff, join_channels, closing_message, channel_types)
+        return
 
-    if csv_filename:
-        csv_file.close()
+    # Rows are written as channels finish, so an interrupted live run still records what it archived
+    with open(csv_filename, 'w', newline='', buffering=65536) as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(['Channel ID', 'Channel Name', 'Reason'])
+        await process_channels(email_domains, dry_run, cutoff, join_channels, closing_message, channel_types,
+                               on_row=csv_writer.writerow)
+
+# Run the cleanup with a single shared HTTP session for all API calls
+async def main(args):
+    global client, persistent_cache, cache_ttl, cache_namespace, bot_user_id
+    cache_ttl = args.cache_ttl
+    # A non-positive TTL disables the on-disk cache entirely
+    persistent_cache = shelve.open(CACHE_FILE) if cache_ttl > 0 else None
+    try:
+        connector = aiohttp.TCPConnector(limit=MAX_POOLED_CONNECTIONS, limit_per_host=MAX_POOLED_CONNECTIONS)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            client = AsyncWebClient(
+                token=args.api_token,
+                session=session,
+                retry_handlers=[
+                    AsyncRateLimitErrorRetryHandler(max_retry_count=10),
+                    AsyncConnectionErrorRetryHandler(max_retry_count=5),
+                    ServerErrorRetryHandler(max_retry_count=5),
+                ],
+            )
+            auth = await client.auth_test()
+            bot_user_id = auth['user_id']
+            cache_namespace = auth['team_id']
+            dry_run = not args.live
+            await clean_up_slack(args.email_domains, dry_run, args.days, args.join_channels,
+                                 args.csv, args.closing_message, args.channel_types)
+    finally:
+        if persistent_cache is not None:
+            persistent_cache.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Clean up Slack channels.")
@@ -221,6 +465,10 @@ if __name__ == "__main__":
     parser.add_argument("--csv", type=str, help="Output archived channels to a CSV file")
     parser.add_argument("--closing-message", type=str, 
                        help="Message to post in the channel before archiving")
+    parser.add_argument("--channel-types", type=parse_channel_types, default="public_channel",
+                       help=f"Comma-separated conversation types to check ({','.join(CHANNEL_TYPES)})")
+    parser.add_argument("--cache-ttl", type=int, default=86400,
+                       help="Seconds to reuse cached users and channel members between runs (0 disables)")
 
     args = parser.parse_args()
 
@@ -251,7 +499,10 @@ if __name__ == "__main__":
     if args.closing_message:
         print(f"Will post closing message before archiving: {args.closing_message}")
 
-    client = WebClient(token=args.api_token)
-    dry_run = not args.live
-    clean_up_slack(args.email_domains, dry_run, args.days, args.join_channels, 
-                  args.csv, args.closing_message)
\ No newline at end of file
+    if args.channel_types != ['public_channel']:
+        print(f"Checking conversation types: {', '.join(args.channel_types)}")
+
+    if args.cache_ttl > 0:
+        print(f"Reusing cached users and channel members for up to {args.cache_ttl} seconds")
+
+    asyncio.run(main(args))